@@ -8,32 +8,134 @@ Chat always has access to original PDFs via signed URLs.
 import re
 import os
 import asyncio
-import threading
 import base64
-import json
 import io
-from typing import List, Optional, Dict, Any
+import httpx
+import functools
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Dict, Any, Union
+from urllib.parse import quote
 from concurrent.futures import ThreadPoolExecutor
-from fastapi import FastAPI, UploadFile, File
+from fastapi import BackgroundTasks, FastAPI, Request, Response, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, TypeAdapter
+import anyio.to_thread
+import orjson
+import msgspec
+
+# Lazy %-style arguments: DEBUG detail costs nothing unless LOG_LEVEL=DEBUG
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger("revipro")
+
+# AI Integration (SDKs are imported lazily on first use to keep cold starts fast)
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
-# AI Integration
-from anthropic import Anthropic
-from supabase import create_client, Client
-from google import genai as google_genai
+if TYPE_CHECKING:
+    from anthropic import AsyncAnthropic
+    from google.genai import Client as GeminiClient
+    from supabase import Client
 
-# Initialize Anthropic client
+# Anthropic client
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 if not ANTHROPIC_API_KEY:
     raise ValueError("ANTHROPIC_API_KEY environment variable is required")
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+FILES_API_BETA = "files-api-2025-04-14"  # PDFs are uploaded once and referenced by file_id
+
+
+@functools.lru_cache(maxsize=1)
+def get_anthropic_client() -> "AsyncAnthropic":
+    from anthropic import AsyncAnthropic
+    # Retries are handled by llm_retry; SDK retries on top would multiply the attempts
+    return AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
 
-# Initialize Gemini 3 client
+
+# Gemini 3 client
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable is required")
-gemini_client = google_genai.Client(api_key=GEMINI_API_KEY)
+
+
+@functools.lru_cache(maxsize=1)
+def get_gemini_client() -> "GeminiClient":
+    from google import genai as google_genai
+    return google_genai.Client(api_key=GEMINI_API_KEY)
+
+
+def gemini_pdf_part(file_bytes: bytes):
+    """Wrap PDF bytes as a Gemini content part."""
+    from google.genai import types as genai_types
+    return genai_types.Part.from_bytes(data=file_bytes, mime_type="application/pdf")
+
+
+# Max concurrent LLM requests per worker
+LLM_CONCURRENCY = 5
+llm_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """Return the LLM semaphore, created lazily inside the running event loop."""
+    global llm_semaphore
+    if llm_semaphore is None:
+        llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    return llm_semaphore
+
+
+def is_retryable_llm_error(exc: BaseException) -> bool:
+    """Rate limits, overload and connection errors are worth retrying; bad requests are not."""
+    import anthropic
+    from google.genai import errors as genai_errors
+    if isinstance(exc, (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError)):
+        return True
+    # 529 overloaded is raised as its own APIStatusError subclass, not InternalServerError
+    if isinstance(exc, anthropic.APIStatusError):
+        return exc.status_code == 529
+    if isinstance(exc, genai_errors.APIError):
+        return exc.code in (429, 500, 503)
+    return False
+
+
+# Exponential backoff with jitter (1s .. 60s, 6 attempts) for transient provider errors
+llm_retry = retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    retry=retry_if_exception(is_retryable_llm_error),
+    reraise=True
+)
+
+
+@llm_retry
+async def create_claude_message(**kwargs):
+    """Claude messages.create with concurrency limit and retries."""
+    async with get_llm_semaphore():
+        return await get_anthropic_client().beta.messages.create(**kwargs)
+
+
+@llm_retry
+async def generate_gemini_content(**kwargs):
+    """Gemini generate_content with concurrency limit and retries."""
+    async with get_llm_semaphore():
+        return await get_gemini_client().aio.models.generate_content(**kwargs)
+
+
+# Optional Redis for chat sessions shared across workers (falls back to in-process dict)
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_client = aioredis.from_url(REDIS_URL)
+else:
+    logger.warning("REDIS_URL not set: chat sessions are kept per worker and lost on restart")
+
+# Optional direct Postgres pool for hot read paths (skips the PostgREST HTTP hop)
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")
+db_pool = None  # asyncpg pool, created on startup when SUPABASE_DB_URL is set
 
 # Initialize Supabase client with Service Role Key
 SUPABASE_URL = os.environ.get("SUPABASE_URL", "https://poeulzxkjcxeszfcsiks.supabase.co")
@@ -42,17 +144,151 @@ if SUPABASE_URL:
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 if not SUPABASE_KEY:
     raise ValueError("SUPABASE_KEY environment variable is required")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+SUPABASE_DB_TIMEOUT = 10  # seconds per PostgREST request
+
+
+@functools.lru_cache(maxsize=1)
+def get_supabase() -> "Client":
+    # One client per process: its PostgREST session keeps connections alive across requests
+    from supabase import ClientOptions, create_client
+    return create_client(
+        SUPABASE_URL,
+        SUPABASE_KEY,
+        options=ClientOptions(postgrest_client_timeout=SUPABASE_DB_TIMEOUT)
+    )
+
+
+# Shared keep-alive HTTP/2 pool for Supabase Storage REST calls (uploads, downloads, signed URLs)
+STORAGE_URL = f"{SUPABASE_URL}storage/v1"
+STORAGE_BUCKET = "documents"
+storage_http = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0),
+    headers={"Authorization": f"Bearer {SUPABASE_KEY}", "apikey": SUPABASE_KEY}
+)
+
+
+def storage_object_url(storage_path: str) -> str:
+    return f"{STORAGE_URL}/object/{STORAGE_BUCKET}/{quote(storage_path)}"
 
 # Session storage for chat history (local cache, backed by Supabase)
 import uuid
-from datetime import datetime
 import time
 
-chat_sessions: Dict[str, Dict] = {}  # session_id -> {messages: [], pdf_urls: [], created_at: datetime}
-
-# Thread pool for async operations
-executor = ThreadPoolExecutor(max_workers=4)
+# session_id -> (expires_at, {messages: [], pdf_urls: [], created_at: epoch seconds}), oldest save first
+chat_sessions: "OrderedDict[str, tuple]" = OrderedDict()
+SESSION_TTL_SECONDS = 24 * 3600
+SESSION_CACHE_MAX_ENTRIES = 1000  # in-process fallback only; Redis handles its own memory
+SESSION_MAX_MESSAGES = 20
+SUMMARY_KEEP_MESSAGES = 10  # once over the max, older messages are folded into a summary
+SESSION_MAX_HISTORY_CHARS = 32000  # ~8k tokens of verbatim history per request
+SUMMARY_MODEL = "claude-haiku-4-5"
+RESUBMIT_WINDOW_SECONDS = 5  # same message and model this soon after its answer counts as a double submit
+
+# Recently downloaded PDFs so repeated Gemini turns skip the Storage download
+PDF_CACHE_MAX_ENTRIES = 20
+PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+pdf_bytes_cache: "OrderedDict[str, bytes]" = OrderedDict()  # storage_path -> bytes
+pdf_cache_bytes = 0  # total size of pdf_bytes_cache values
+
+# Thread pool for blocking I/O (supabase-py, SDK calls); mostly waiting on the network, so size above CPU count
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", "16"))
+executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+ANYIO_THREAD_TOKENS = 100  # Starlette runs UploadFile reads/writes on anyio's pool (default 40)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call (supabase-py, SDK I/O) on the thread pool without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+inflight_loads: Dict[str, asyncio.Future] = {}
+
+
+async def single_flight(key: str, load):
+    """Run load() once per key at a time; concurrent callers share its result."""
+    task = inflight_loads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(load())
+        inflight_loads[key] = task
+        task.add_done_callback(lambda _: inflight_loads.pop(key, None))
+    # shield: a caller that disconnects must not cancel the load for the others
+    return await asyncio.shield(task)
+
+
+# ============== Chat Session Store ==============
+
+def history_chars(messages: List[dict]) -> int:
+    return sum(len(str(msg["content"])) for msg in messages)
+
+
+def trim_history(messages: List[dict], max_messages: int = SESSION_MAX_MESSAGES) -> List[dict]:
+    """Keep the most recent messages within the count and size budget, starting with a user turn."""
+    trimmed = messages[-max_messages:]
+    total = history_chars(trimmed)
+    # Never evict the latest user turn (or the reply to it), however long it is
+    last_user = max((i for i, msg in enumerate(trimmed) if msg["role"] == "user"), default=0)
+    while last_user > 0 and total > SESSION_MAX_HISTORY_CHARS:
+        total -= len(str(trimmed[0]["content"]))
+        trimmed = trimmed[1:]
+        last_user -= 1
+    while trimmed and trimmed[0]["role"] != "user":
+        trimmed = trimmed[1:]
+    return trimmed
+
+
+async def load_chat_session(session_id: str) -> Optional[Dict]:
+    """Load a chat session from Redis, falling back to the local cache."""
+    if redis_client is not None:
+        try:
+            raw = await redis_client.get(f"sess:{session_id}")
+            if raw:
+                return orjson.loads(raw)
+        except Exception as e:
+            logger.warning("Redis session read failed, using local cache: %s", e)
+    # Also consulted after a Redis miss: sessions saved while Redis was unreachable live here
+    entry = chat_sessions.get(session_id)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        chat_sessions.pop(session_id, None)
+        return None
+    return entry[1]
+
+
+async def save_chat_session(session_id: str, session: Dict) -> None:
+    """Store a chat session with a bounded history and TTL."""
+    session["messages"] = trim_history(session.get("messages", []))
+    if redis_client is not None:
+        try:
+            await redis_client.setex(f"sess:{session_id}", SESSION_TTL_SECONDS, orjson.dumps(session, default=str))
+            # Drop any copy saved locally during an outage so it can't shadow the Redis one later
+            chat_sessions.pop(session_id, None)
+            return
+        except Exception as e:
+            logger.warning("Redis session write failed, keeping session in local cache: %s", e)
+    now = time.monotonic()
+    chat_sessions[session_id] = (now + SESSION_TTL_SECONDS, session)
+    chat_sessions.move_to_end(session_id)
+    # Entries are ordered by expiry, so expired and overflow sessions are at the front
+    while chat_sessions and (
+        len(chat_sessions) > SESSION_CACHE_MAX_ENTRIES or next(iter(chat_sessions.values()))[0] <= now
+    ):
+        chat_sessions.popitem(last=False)
+
+
+async def delete_chat_session(session_id: str) -> None:
+    """Remove a chat session from Redis and the local cache."""
+    if redis_client is not None:
+        try:
+            await redis_client.delete(f"sess:{session_id}")
+        except Exception as e:
+            logger.warning("Redis session delete failed: %s", e)
+    chat_sessions.pop(session_id, None)
 
 
 # ============== Pydantic Models ==============
@@ -109,6 +345,11 @@ class AnalysisResponse(BaseModel):
     session_id: Optional[str] = None
 
 
+# Batch validators for item lists, built once
+TAX_ITEMS_ADAPTER = TypeAdapter(List[TaxItem])
+FIBU_ITEMS_ADAPTER = TypeAdapter(List[FibuItem])
+
+
 class ChatRequest(BaseModel):
     session_id: str
     message: str
@@ -130,10 +371,28 @@ class ReprocessRequest(BaseModel):
 
 # ============== FastAPI App ==============
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background workers and pools; on shutdown drain the writer before closing what it uses."""
+    configure_thread_pools()
+    await open_db_pool()
+    start_supabase_writer()
+    start_session_reaper()
+    try:
+        yield
+    finally:
+        await stop_session_reaper()
+        await stop_supabase_writer()
+        await close_db_pool()
+        await close_storage_http()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Revipro Reconciliation Engine",
     description="LLM-Only PDF Analysis for Swiss Tax Audits",
-    version="6.0.0"
+    version="6.0.0",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -145,85 +404,578 @@ app.add_middleware(
 )
 
 
+# ============== Background Supabase Writer ==============
+
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.2  # seconds to wait for more rows before flushing
+WRITE_QUEUE_MAX_ROWS = 10000  # producers wait once this many rows are pending
+INSERT_CHUNK_ROWS = 500  # keeps a single PostgREST insert body well below its size limit
+write_queue: Optional[asyncio.Queue] = None  # (table, row) tuples, created on startup
+writer_task: Optional[asyncio.Task] = None
+
+
+def is_retryable_db_error(exc: BaseException) -> bool:
+    """Only retry failures where the write cannot have been applied, so retried inserts never duplicate rows."""
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in (429, 503)
+    # postgrest APIError reports gateway/rate-limit responses with the HTTP status as code
+    return str(getattr(exc, "code", "")) in ("429", "503")
+
+
+# Exponential backoff with jitter (1s .. 30s, 5 attempts) for rate-limited or unreachable Supabase writes
+db_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception(is_retryable_db_error),
+    reraise=True
+)
+
+
+@db_retry
+def insert_chunk(table: str, rows: List[dict]) -> None:
+    get_supabase().table(table).insert(rows).execute()
+
+
+def insert_rows(table: str, rows: List[dict]) -> None:
+    """Insert several rows into a table, one request per INSERT_CHUNK_ROWS rows.
+
+    A chunk rejected for its content (e.g. one row with a stale session_id FK) is retried row
+    by row, so one bad row from one session does not drop the other sessions' rows.
+    """
+    for start in range(0, len(rows), INSERT_CHUNK_ROWS):
+        chunk = rows[start:start + INSERT_CHUNK_ROWS]
+        try:
+            insert_chunk(table, chunk)
+        except Exception as e:
+            if len(chunk) == 1 or is_retryable_db_error(e):
+                logger.error("Batch insert error (%s, %s rows): %s", table, len(chunk), e)
+                continue
+            logger.warning("Batch insert rejected (%s, %s rows), inserting one by one: %s", table, len(chunk), e)
+            for row in chunk:
+                try:
+                    insert_chunk(table, [row])
+                except Exception as row_error:
+                    logger.error("Row insert error (%s): %s", table, row_error)
+
+
+async def flush_rows(batch: List[tuple]) -> None:
+    """Group queued rows by table and insert each group in one call."""
+    rows_by_table: Dict[str, List[dict]] = {}
+    for table, row in batch:
+        rows_by_table.setdefault(table, []).append(row)
+    for table, rows in rows_by_table.items():
+        await run_blocking(insert_rows, table, rows)
+
+
+async def supabase_writer():
+    """Drain the write queue, flushing every WRITE_BATCH_SIZE rows or WRITE_FLUSH_INTERVAL."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await write_queue.get()]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        try:
+            while len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(write_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Also runs on shutdown cancellation, so rows already taken off the queue are not lost
+            await asyncio.shield(flush_rows(batch))
+
+
+async def enqueue_insert(table: str, *rows: dict) -> None:
+    """Queue rows for the background writer (inserts them in one call if the writer is not running)."""
+    if write_queue is None:
+        await run_blocking(insert_rows, table, list(rows))
+        return
+    for row in rows:
+        await write_queue.put((table, row))
+
+
+def start_supabase_writer():
+    global write_queue, writer_task
+    write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_MAX_ROWS)
+    writer_task = asyncio.create_task(supabase_writer())
+
+
+def configure_thread_pools():
+    """Route every thread offload (ours, asyncio.to_thread, Starlette's upload I/O) to sized pools."""
+    asyncio.get_running_loop().set_default_executor(executor)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ANYIO_THREAD_TOKENS
+
+
+async def stop_supabase_writer():
+    if writer_task is not None:
+        writer_task.cancel()
+        await asyncio.gather(writer_task, return_exceptions=True)
+    if write_queue is not None:
+        pending = []
+        while not write_queue.empty():
+            pending.append(write_queue.get_nowait())
+        if pending:
+            await flush_rows(pending)
+
+
+async def close_storage_http():
+    await storage_http.aclose()
+
+
+SESSION_REAP_INTERVAL = 300  # seconds between sweeps of expired in-process entries
+reaper_task: Optional[asyncio.Task] = None
+
+
+def reap_expired_entries() -> None:
+    """Drop expired chat sessions and lookups that nobody has read since they expired."""
+    now = time.monotonic()
+    # Sessions are ordered by expiry, so the expired ones are at the front
+    while chat_sessions and next(iter(chat_sessions.values()))[0] <= now:
+        chat_sessions.popitem(last=False)
+    for cache_key in [k for k, (expires_at, _) in lookup_cache.items() if expires_at <= now]:
+        del lookup_cache[cache_key]
+
+
+async def session_reaper():
+    """Periodically evict expired in-process entries so idle sessions don't hold memory."""
+    while True:
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
+        reap_expired_entries()
+
+
+def start_session_reaper():
+    global reaper_task
+    reaper_task = asyncio.create_task(session_reaper())
+
+
+async def stop_session_reaper():
+    if reaper_task is not None:
+        reaper_task.cancel()
+        await asyncio.gather(reaper_task, return_exceptions=True)
+
+
+async def open_db_pool():
+    global db_pool
+    if not SUPABASE_DB_URL:
+        return
+    import asyncpg
+    try:
+        # statement_cache_size=0 keeps the pool compatible with Supavisor transaction mode
+        db_pool = await asyncpg.create_pool(
+            dsn=SUPABASE_DB_URL,
+            min_size=1,
+            max_size=10,
+            max_inactive_connection_lifetime=300,
+            statement_cache_size=0
+        )
+    except Exception as e:
+        logger.warning("Postgres pool unavailable, using PostgREST: %s", e)
+
+
+async def close_db_pool():
+    if db_pool is not None:
+        await db_pool.close()
+
+
 # ============== Supabase Helper Functions ==============
 
-def save_document_to_supabase(
-    session_id: str,
-    filename: str,
-    file_bytes: bytes,
-) -> Optional[str]:
-    """Save PDF to Supabase Storage and return the storage path."""
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CONCURRENCY = 8  # PDFs uploaded at once per worker
+upload_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def get_upload_semaphore() -> asyncio.Semaphore:
+    """Return the upload semaphore, created lazily inside the running event loop."""
+    global upload_semaphore
+    if upload_semaphore is None:
+        upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    return upload_semaphore
+
+
+async def upload_to_storage(storage_path: str, file: Union[UploadFile, bytes]) -> Optional[str]:
+    """Stream an uploaded PDF (or already-read bytes) to Supabase Storage; return its SHA-256 (None on failure)."""
+    digest = hashlib.sha256()
+    
+    async def chunks():
+        await file.seek(0)
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            yield chunk
+    
+    headers = {"Content-Type": "application/pdf"}
+    if isinstance(file, bytes):
+        digest.update(file)
+        content = file
+    else:
+        content = chunks()
+        if file.size is not None:
+            headers["Content-Length"] = str(file.size)
     try:
-        storage_path = f"{session_id}/{filename}"
-        
-        # Upload to storage
-        supabase.storage.from_("documents").upload(
-            storage_path, 
-            file_bytes, 
-            {"content-type": "application/pdf"}
+        response = await storage_http.post(storage_object_url(storage_path), content=content, headers=headers)
+        response.raise_for_status()
+        logger.debug("Saved to Supabase: %s", storage_path)
+        return digest.hexdigest()
+    except Exception as e:
+        logger.error("Error saving to Supabase: %s", e)
+        return None
+
+
+async def upload_to_anthropic(filename: str, file_bytes: bytes) -> Optional[str]:
+    """Upload a PDF to the Anthropic Files API so messages can reference it by file_id."""
+    try:
+        # Not wrapped in llm_retry, so let the SDK retry transient failures itself
+        uploaded = await get_anthropic_client().with_options(max_retries=2).beta.files.upload(
+            file=(filename, file_bytes, "application/pdf"),
+            betas=[FILES_API_BETA]
         )
-        
-        # Save metadata to documents table
-        supabase.table("documents").insert({
-            "session_id": session_id,
-            "filename": filename,
-            "file_path": storage_path,
-            "document_type": "pending",
-            "extracted_data": {}
-        }).execute()
-        
-        print(f"  Saved to Supabase: {storage_path}")
-        return storage_path
+        return uploaded.id
     except Exception as e:
-        print(f"  Error saving to Supabase: {e}")
+        logger.error("Error uploading to Anthropic Files API: %s", e)
         return None
 
 
-def get_signed_url(storage_path: str, expires_in: int = 3600) -> Optional[str]:
+async def delete_from_anthropic(file_id: str) -> None:
+    """Delete a previously uploaded PDF from the Anthropic Files API."""
+    try:
+        await get_anthropic_client().with_options(max_retries=2).beta.files.delete(file_id, betas=[FILES_API_BETA])
+    except Exception as e:
+        logger.error("Error deleting Anthropic file %s: %s", file_id, e)
+
+
+async def upload_pdf(session_id: str, file: UploadFile, upload_to_claude: bool = True) -> Optional[dict]:
+    """Upload a PDF to Storage (and, for Claude runs, the Anthropic Files API); return its documents row.
+
+    Storage-only uploads are streamed from FastAPI's spooled temp file instead of being read into memory.
+    For Claude runs the file is read once (off the event loop) and both uploads run concurrently.
+    Returns None on failure.
+    """
+    logger.debug("Uploading: %s (%s bytes)", file.filename, file.size)
+    storage_path = f"{session_id}/{file.filename}"
+    anthropic_file_id = None
+    if upload_to_claude:
+        await file.seek(0)
+        file_bytes = await file.read()
+        sha256, anthropic_file_id = await asyncio.gather(
+            upload_to_storage(storage_path, file_bytes),
+            upload_to_anthropic(file.filename, file_bytes)
+        )
+    else:
+        sha256 = await upload_to_storage(storage_path, file)
+    if not sha256:
+        if anthropic_file_id:
+            await delete_from_anthropic(anthropic_file_id)
+        return None
+    
+    extracted_data = {"sha256": sha256}
+    if anthropic_file_id:
+        extracted_data["anthropic_file_id"] = anthropic_file_id
+    return {
+        "session_id": session_id,
+        "filename": file.filename,
+        "file_path": storage_path,
+        "document_type": "pending",
+        "extracted_data": extracted_data
+    }
+
+
+async def save_documents_to_supabase(session_id: str, files: List[UploadFile], upload_to_claude: bool = True) -> int:
+    """Upload the PDFs (UPLOAD_CONCURRENCY at a time), then insert their metadata in one call. Returns the saved count."""
+    async def bounded_upload(file: UploadFile) -> Optional[dict]:
+        async with get_upload_semaphore():
+            return await upload_pdf(session_id, file, upload_to_claude)
+    
+    rows = [row for row in await asyncio.gather(*[bounded_upload(file) for file in files]) if row]
+    if not rows:
+        return 0
+    try:
+        await run_blocking(insert_chunk, "documents", rows)
+        forget_cached_lookup("documents", session_id)
+        return len(rows)
+    except Exception as e:
+        logger.error("Error saving document metadata: %s", e)
+        # Without their rows the uploads are unreachable, so remove them again
+        file_ids = [row["extracted_data"].get("anthropic_file_id") for row in rows]
+        await asyncio.gather(
+            delete_from_storage([row["file_path"] for row in rows]),
+            *[delete_from_anthropic(file_id) for file_id in file_ids if file_id]
+        )
+        return 0
+
+
+async def get_signed_url(storage_path: str, expires_in: int = 3600) -> Optional[str]:
     """Generate a signed URL for a document in Supabase Storage."""
     try:
-        result = supabase.storage.from_("documents").create_signed_url(storage_path, expires_in)
-        if result and result.get("signedURL"):
-            return result["signedURL"]
+        response = await storage_http.post(
+            f"{STORAGE_URL}/object/sign/{STORAGE_BUCKET}/{quote(storage_path)}",
+            json={"expiresIn": expires_in}
+        )
+        response.raise_for_status()
+        signed_url = response.json().get("signedURL")
+        return f"{STORAGE_URL}{signed_url}" if signed_url else None
+    except Exception as e:
+        logger.error("Error creating signed URL: %s", e)
         return None
+
+
+async def get_signed_urls(storage_paths: List[str], expires_in: int = 3600) -> Dict[str, str]:
+    """Generate signed URLs for several documents with a single Storage request."""
+    if not storage_paths:
+        return {}
+    try:
+        response = await storage_http.post(
+            f"{STORAGE_URL}/object/sign/{STORAGE_BUCKET}",
+            json={"expiresIn": expires_in, "paths": storage_paths}
+        )
+        response.raise_for_status()
+        return {
+            item["path"]: f"{STORAGE_URL}{item['signedURL']}"
+            for item in response.json() or []
+            if item.get("path") and item.get("signedURL") and not item.get("error")
+        }
+    except Exception as e:
+        logger.error("Error creating signed URLs: %s", e)
+        return {}
+
+
+async def download_document(storage_path: str) -> Optional[bytes]:
+    """Download a PDF from Supabase Storage."""
+    try:
+        response = await storage_http.get(storage_object_url(storage_path))
+        response.raise_for_status()
+        return response.content
+    except Exception as e:
+        logger.error("Error downloading %s: %s", storage_path, e)
+        return None
+
+
+async def delete_from_storage(storage_paths: List[str]) -> None:
+    """Remove several PDFs from Supabase Storage with a single request."""
+    if not storage_paths:
+        return
+    try:
+        response = await storage_http.request(
+            "DELETE",
+            f"{STORAGE_URL}/object/{STORAGE_BUCKET}",
+            json={"prefixes": storage_paths}
+        )
+        response.raise_for_status()
     except Exception as e:
-        print(f"  Error creating signed URL: {e}")
+        logger.error("Error deleting %s files from storage: %s", len(storage_paths), e)
+
+
+async def download_pdfs(storage_paths: List[str]) -> List[Optional[bytes]]:
+    """Download several PDFs concurrently, reusing recently downloaded ones."""
+    global pdf_cache_bytes
+    # Snapshot the cached bytes before awaiting: concurrent calls may evict them meanwhile
+    blobs = {path: pdf_bytes_cache.get(path) for path in storage_paths}
+    for path in storage_paths:
+        if path in pdf_bytes_cache:
+            pdf_bytes_cache.move_to_end(path)
+    missing = [path for path in storage_paths if blobs[path] is None]
+    downloaded = await asyncio.gather(*[download_document(path) for path in missing])
+    
+    for path, file_bytes in zip(missing, downloaded):
+        if file_bytes:
+            blobs[path] = file_bytes
+            pdf_cache_bytes += len(file_bytes) - len(pdf_bytes_cache.get(path, b""))
+            pdf_bytes_cache[path] = file_bytes
+    while pdf_bytes_cache and (
+        len(pdf_bytes_cache) > PDF_CACHE_MAX_ENTRIES or pdf_cache_bytes > PDF_CACHE_MAX_BYTES
+    ):
+        _, evicted = pdf_bytes_cache.popitem(last=False)
+        pdf_cache_bytes -= len(evicted)
+    
+    return [blobs[path] for path in storage_paths]
+
+
+def forget_session_pdfs(session_id: str) -> None:
+    """Drop cached PDF bytes belonging to a session."""
+    global pdf_cache_bytes
+    for path in [p for p in pdf_bytes_cache if p.startswith(f"{session_id}/")]:
+        pdf_cache_bytes -= len(pdf_bytes_cache.pop(path))
+
+
+LOOKUP_CACHE_TTL_SECONDS = 300
+LOOKUP_CACHE_MAX_ENTRIES = 512
+lookup_cache: "OrderedDict[tuple, tuple]" = OrderedDict()  # (kind, key) -> (expires_at, value)
+
+
+def get_cached_lookup(kind: str, key: str) -> Optional[Any]:
+    """Return a cached Supabase lookup that has not expired."""
+    entry = lookup_cache.get((kind, key))
+    if entry is None:
         return None
+    if entry[0] <= time.monotonic():
+        del lookup_cache[(kind, key)]
+        return None
+    lookup_cache.move_to_end((kind, key))
+    return entry[1]
+
+
+def store_cached_lookup(kind: str, key: str, value: Any) -> None:
+    """Cache a Supabase lookup for LOOKUP_CACHE_TTL_SECONDS, evicting the least recently used."""
+    lookup_cache[(kind, key)] = (time.monotonic() + LOOKUP_CACHE_TTL_SECONDS, value)
+    lookup_cache.move_to_end((kind, key))
+    while len(lookup_cache) > LOOKUP_CACHE_MAX_ENTRIES:
+        lookup_cache.popitem(last=False)
+
+
+def forget_cached_lookup(kind: str, key: str) -> None:
+    lookup_cache.pop((kind, key), None)
 
 
 async def get_session_documents(session_id: str) -> List[dict]:
     """Get all documents for a session from Supabase."""
+    cached = get_cached_lookup("documents", session_id)
+    if cached is not None:
+        return cached
     try:
-        result = supabase.table("documents").select("*").eq("session_id", session_id).execute()
-        return result.data or []
+        query = get_supabase().table("documents").select("*").eq("session_id", session_id)
+        result = await run_blocking(query.execute)
+        documents = result.data or []
+        # An empty list may just mean the rows are not visible yet, so only cache hits
+        if documents:
+            store_cached_lookup("documents", session_id, documents)
+        return documents
     except Exception as e:
-        print(f"Error getting documents: {e}")
+        logger.error("Error getting documents: %s", e)
         return []
 
 
 async def get_session_pdf_urls(session_id: str) -> List[dict]:
-    """Get signed URLs for all PDFs in a session."""
+    """Get all PDFs in a session, with signed URLs for those not in the Anthropic Files API."""
     documents = await get_session_documents(session_id)
-    pdf_urls = []
+    file_paths = [
+        doc["file_path"] for doc in documents
+        if doc.get("file_path") and not (doc.get("extracted_data") or {}).get("anthropic_file_id")
+    ]
+    
+    # One batch request for all URLs; fall back to concurrent single requests for any gaps
+    signed_urls = await get_signed_urls(file_paths)
+    missing = [path for path in file_paths if path not in signed_urls]
+    if missing:
+        urls = await asyncio.gather(*[get_signed_url(path) for path in missing])
+        signed_urls.update({path: url for path, url in zip(missing, urls) if url})
     
+    pdf_urls = []
     for doc in documents:
         file_path = doc.get("file_path")
-        if file_path:
-            url = get_signed_url(file_path)
-            if url:
-                pdf_urls.append({
-                    "filename": doc.get("filename"),
-                    "url": url,
-                    "file_path": file_path
-                })
+        extracted_data = doc.get("extracted_data") or {}
+        file_id = extracted_data.get("anthropic_file_id")
+        url = signed_urls.get(file_path) if file_path else None
+        if file_path and (file_id or url):
+            pdf_urls.append({
+                "filename": doc.get("filename"),
+                "url": url,
+                "file_path": file_path,
+                "sha256": extracted_data.get("sha256"),
+                "anthropic_file_id": file_id
+            })
     
     return pdf_urls
 
 
+def document_block(pdf: dict) -> dict:
+    """Claude document block: the uploaded file_id if available, else the signed URL."""
+    if pdf.get("anthropic_file_id"):
+        return {
+            "type": "document",
+            "source": {
+                "type": "file",
+                "file_id": pdf["anthropic_file_id"]
+            }
+        }
+    return {
+        "type": "document",
+        "source": {
+            "type": "url",
+            "url": pdf["url"]
+        }
+    }
+
+
+def mark_cache_breakpoint(blocks: List[dict]) -> List[dict]:
+    """Mark the last block for Anthropic prompt caching so later calls reuse the prefix."""
+    if blocks:
+        blocks[-1] = {**blocks[-1], "cache_control": {"type": "ephemeral"}}
+    return blocks
+
+
+def log_claude_usage(response) -> None:
+    """Log token usage, including how much of the prompt came from Anthropic's prompt cache."""
+    usage = response.usage
+    logger.info(
+        "Claude usage: %s input, %s cache read, %s cache write, %s output tokens",
+        usage.input_tokens,
+        getattr(usage, "cache_read_input_tokens", 0) or 0,
+        getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        usage.output_tokens
+    )
+
+
+ANALYSIS_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+
+def analysis_cache_key(pdf_urls: List[dict], model: str, prompt: str) -> Optional[str]:
+    """Build a cache key from the PDF contents and names, model and prompt (None if a hash is missing)."""
+    hashes = [pdf.get("sha256") for pdf in pdf_urls]
+    if not hashes or not all(hashes):
+        return None
+    digest = hashlib.sha256()
+    # Filenames are part of the key because the result cites them in documents and source
+    for h, filename in sorted((pdf["sha256"], pdf.get("filename") or "") for pdf in pdf_urls):
+        digest.update(h.encode())
+        digest.update(filename.encode())
+    digest.update(model.encode())
+    digest.update(prompt.encode())
+    return digest.hexdigest()
+
+
+def get_cached_analysis(cache_key: str) -> Optional[dict]:
+    """Look up a previous LLM analysis for identical PDFs, if younger than ANALYSIS_CACHE_TTL_SECONDS."""
+    cutoff = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - ANALYSIS_CACHE_TTL_SECONDS))
+    try:
+        result = (
+            get_supabase().table("llm_cache").select("result")
+            .eq("key", cache_key).gte("created_at", cutoff)
+            .limit(1).execute()
+        )
+        if result.data:
+            return result.data[0]["result"]
+        return None
+    except Exception as e:
+        logger.error("Error reading analysis cache: %s", e)
+        return None
+
+
+def store_cached_analysis(cache_key: str, model: str, result: dict) -> None:
+    """Store an LLM analysis so identical PDFs skip inference next time."""
+    try:
+        get_supabase().table("llm_cache").upsert({
+            "key": cache_key,
+            "model": model,
+            "result": result,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        }).execute()
+    except Exception as e:
+        logger.error("Error writing analysis cache: %s", e)
+
+
 async def get_client_knowledge(client_name: str) -> dict:
     """Get all stored knowledge for a client."""
+    cached = get_cached_lookup("client_knowledge", client_name)
+    if cached is not None:
+        return cached
     try:
-        result = supabase.table("client_knowledge").select("*").eq("client_name", client_name).execute()
+        query = get_supabase().table("client_knowledge").select("*").eq("client_name", client_name)
+        result = await run_blocking(query.execute)
         knowledge = {
             "column_preferences": [],
             "typical_accounts": [],
@@ -237,9 +989,10 @@ async def get_client_knowledge(client_name: str) -> dict:
                 knowledge["typical_accounts"].append(row.get("value", {}))
             elif "anomal" in k_type or "pattern" in k_type:
                 knowledge["known_anomalies"].append(row.get("value", {}))
+        store_cached_lookup("client_knowledge", client_name, knowledge)
         return knowledge
     except Exception as e:
-        print(f"Error getting client knowledge: {e}")
+        logger.error("Error getting client knowledge: %s", e)
         return {}
 
 
@@ -359,23 +1112,174 @@ Summe(negative Restanzen) = FiBu 2002.00 Endsaldo
 """
 
 
+# System prompt for careful analysis
+ANALYSIS_SYSTEM_PROMPT = """Du bist ein erfahrener Steuerprüfer für Schweizer Gemeinden.
+Deine Aufgabe ist es, Steuerdokumente SEHR SORGFÄLTIG zu analysieren.
+
+WICHTIG:
+- Lies JEDES Dokument VOLLSTÄNDIG durch
+- Scrolle durch ALLE Seiten in JEDEM PDF
+- Achte auf die RICHTIGE Spalte (meist "Politische Gemeinde")
+- Bei FiBu-Auszügen: Nimm den ENDSALDO, nicht Startsaldo
+- Prüfe deine Berechnungen DOPPELT
+
+Wenn du unsicher bist, sage es. Lieber einmal mehr prüfen als falsche Zahlen liefern."""
+
+# System prompt for the audit chat (session context is appended per request)
+CHAT_SYSTEM_PROMPT = """Du bist ein Experte für Schweizer Gemeindesteuerprüfung.
+
+Du hast Zugriff auf die hochgeladenen PDF-Dokumente und kannst sie jederzeit lesen.
+
+## DEIN FACHWISSEN:
+
+### Dokumenttypen:
+- **JA (Jahresabrechnung)**: Zeile 45 "Total Restanzen" = SOLL-Buchung
+- **SR (Steuerrestanzen)**: Zeile 45 = HABEN (Auflösung), Zeile 51 = SOLL (neuer Stand)
+- **NAST (Nachsteuern)**: Zeile 38/44 "Total Restanzen"
+
+### Kontenlogik:
+- **Konto 1012.00**: POSITIVE Restanzen (Steuerforderungen)
+- **Konto 2002.00**: NEGATIVE Restanzen (als positiver Wert auf Passivseite)
+
+### Spalten:
+- Gemeinden: "Politische Gemeinde"
+- Kirchen: "ref. Kirche" oder "kath. Kirche"
+- Schulen: "Sekundarschule"
+
+## KOMMUNIKATION:
+- Antworte IMMER auf Deutsch
+- KEINE Markdown-Headers (##, ###)
+- Schreibe natürlichen Fliesstext
+- Für Listen: • oder - am Zeilenanfang
+- Zahlen: CHF X'XXX.XX
+- Kurz und prägnant (max 3-4 Absätze)
+
+## WICHTIG:
+Wenn der Benutzer fragt "lies nochmal" oder "prüfe nochmals", dann LESE die PDFs erneut und extrahiere die Daten frisch.
+Du hast IMMER Zugriff auf die Original-PDFs!
+"""
+
+# Structured output schema for the analysis (Claude tool input / Gemini response_schema)
+RULE_ITEMS_SCHEMA = {
+    "tax_items": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "year": {"type": "string"},
+                "type": {"type": "string", "enum": ["JA", "SR", "NAST"]},
+                "amount": {"type": "number"},
+                "source": {"type": "string"},
+                "zeile": {"type": "integer"}
+            },
+            "required": ["year", "type", "amount", "source"]
+        }
+    },
+    "fibu_items": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "account": {"type": "string"},
+                "amount": {"type": "number"},
+                "source": {"type": "string"}
+            },
+            "required": ["account", "amount", "source"]
+        }
+    }
+}
+
+RULE_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "tax_total": {"type": "number"},
+        "fibu_total": {"type": "number"},
+        "difference": {"type": "number"},
+        "status": {"type": "string", "enum": ["MATCH", "MISMATCH", "NO_DATA", "INCOMPLETE"]},
+        "calculation": {"type": "string"},
+        **RULE_ITEMS_SCHEMA
+    },
+    "required": ["status", "difference", "tax_items", "fibu_items"]
+}
+
+AUDIT_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "organization_name": {"type": "string"},
+        "documents": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "filename": {"type": "string"},
+                    "type": {"type": "string", "enum": ["JA", "SR", "NAST", "FiBu"]},
+                    "year": {"type": "string"},
+                    "page_info": {"type": "string"},
+                    "data": {
+                        "type": "object",
+                        "properties": {
+                            "restanzen_gemeinde": {"type": "number"},
+                            "zeile": {"type": "integer"},
+                            "spalte": {"type": "string"},
+                            "is_negative": {"type": "boolean"},
+                            "account": {"type": "string"},
+                            "saldo": {"type": "number"}
+                        }
+                    }
+                },
+                "required": ["filename", "type"]
+            }
+        },
+        "r805_result": RULE_RESULT_SCHEMA,
+        "r806_result": RULE_RESULT_SCHEMA,
+        "findings": {"type": "array", "items": {"type": "string"}},
+        "recommendations": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["organization_name", "documents", "r805_result", "r806_result", "findings", "recommendations"]
+}
+
+AUDIT_TOOL = {
+    "name": "emit_audit",
+    "description": "Gib das vollständige Prüfungsergebnis im vorgegebenen Format zurück.",
+    "input_schema": AUDIT_RESULT_SCHEMA
+}
+
+
+# Frontend model choice -> provider model (Claude Sonnet is the default)
+GEMINI_MODELS = {"gemini-pro": "gemini-3-pro-preview", "gemini-flash": "gemini-3-flash-preview"}
+CLAUDE_MODELS = {"opus": "claude-opus-4-5", "sonnet": "claude-sonnet-4-5"}
+
+
+def is_gemini_model(model: str) -> bool:
+    return model in GEMINI_MODELS
+
+
+def gemini_model_name(model: str) -> str:
+    return GEMINI_MODELS.get(model, GEMINI_MODELS["gemini-flash"])
+
+
+def claude_model_name(model: str) -> str:
+    return CLAUDE_MODELS.get(model, CLAUDE_MODELS["sonnet"])
+
+
 async def analyze_pdfs_with_llm(
     session_id: str,
-    model: str = "sonnet"
+    model: str = "sonnet",
+    prompt: str = SWISS_TAX_AUDIT_PROMPT,
+    use_cache: bool = True
 ) -> dict:
     """
     Analyze all PDFs in a session using LLM Vision.
     PDFs are sent via signed URLs - the LLM reads them directly.
+    With use_cache=False the model is always called; the fresh result still replaces the cached one.
     """
-    print(f"\n{'='*60}")
-    print(f"Analyzing PDFs with LLM for session: {session_id}")
-    print(f"Model: {model}")
+    logger.info("Analyzing PDFs with LLM for session: %s (model: %s)", session_id, model)
     
     # Get all PDF URLs for this session
     pdf_urls = await get_session_pdf_urls(session_id)
     
     if not pdf_urls:
-        print("No PDFs found for session")
+        logger.info("No PDFs found for session")
         return {
             "organization_name": "Unbekannt",
             "documents": [],
@@ -385,50 +1289,54 @@ async def analyze_pdfs_with_llm(
             "recommendations": ["Bitte laden Sie die Steuerdokumente und FiBu-Kontoauszüge hoch"]
         }
     
-    print(f"Found {len(pdf_urls)} PDFs to analyze")
+    logger.info("Found %s PDFs to analyze", len(pdf_urls))
     for pdf in pdf_urls:
-        print(f"  - {pdf['filename']}")
+        logger.debug("- %s", pdf['filename'])
+    
+    # Identical PDFs analyzed before with the same model -> skip the LLM call
+    cache_key = analysis_cache_key(pdf_urls, model, prompt)
+    if cache_key and use_cache:
+        # In-process first (saves the llm_cache read when identical PDFs are analyzed again), then llm_cache
+        cached = get_cached_lookup("analysis", cache_key)
+        if cached is None:
+            cached = await run_blocking(get_cached_analysis, cache_key)
+            if cached:
+                store_cached_lookup("analysis", cache_key, cached)
+        if cached:
+            logger.info("Analysis cache hit: %s", cached.get('organization_name', 'Unknown'))
+            return cached
     
     # Build content array with all PDFs
-    content = []
-    for pdf in pdf_urls:
-        content.append({
-            "type": "document",
-            "source": {
-                "type": "url",
-                "url": pdf["url"]
-            }
-        })
+    content = mark_cache_breakpoint([document_block(pdf) for pdf in pdf_urls])
     
     # Add the analysis prompt
     content.append({
         "type": "text",
-        "text": SWISS_TAX_AUDIT_PROMPT
+        "text": prompt
     })
     
     try:
-        if model in ["gemini-pro", "gemini-flash"]:
+        if is_gemini_model(model):
             # Use Gemini 3 for large PDFs
-            gemini_model = "gemini-3-pro-preview" if model == "gemini-pro" else "gemini-3-flash-preview"
-            print(f"Using Gemini: {gemini_model}")
+            gemini_model = gemini_model_name(model)
+            logger.debug("Using Gemini: %s", gemini_model)
             
             # For Gemini, we need to download and upload PDFs
             gemini_parts = []
-            for pdf in pdf_urls:
-                # Download from Supabase
-                file_bytes = supabase.storage.from_("documents").download(pdf["file_path"])
+            blobs = await download_pdfs([pdf["file_path"] for pdf in pdf_urls])
+            for file_bytes in blobs:
                 if file_bytes:
-                    part = google_genai.types.Part.from_bytes(
-                        data=file_bytes,
-                        mime_type="application/pdf"
-                    )
-                    gemini_parts.append(part)
+                    gemini_parts.append(gemini_pdf_part(file_bytes))
             
-            gemini_parts.append(SWISS_TAX_AUDIT_PROMPT)
+            gemini_parts.append(prompt)
             
-            response = gemini_client.models.generate_content(
+            response = await generate_gemini_content(
                 model=gemini_model,
-                contents=gemini_parts
+                contents=gemini_parts,
+                config={
+                    "response_mime_type": "application/json",
+                    "response_schema": AUDIT_RESULT_SCHEMA
+                }
             )
             
             response_text = getattr(response, "text", "") or ""
@@ -437,63 +1345,39 @@ async def analyze_pdfs_with_llm(
                     part.text for part in response.candidates[0].content.parts
                     if hasattr(part, "text")
                 ])
+            logger.debug("LLM response received (%s chars)", len(response_text))
+            result = orjson.loads(response_text)
         else:
             # Use Claude Sonnet/Opus with extended thinking for accuracy
-            model_name = "claude-opus-4-5" if model == "opus" else "claude-sonnet-4-5"
-            print(f"Using Claude: {model_name}")
+            model_name = claude_model_name(model)
+            logger.debug("Using Claude: %s", model_name)
             
-            # System prompt for careful analysis
-            system_prompt = """Du bist ein erfahrener Steuerprüfer für Schweizer Gemeinden.
-Deine Aufgabe ist es, Steuerdokumente SEHR SORGFÄLTIG zu analysieren.
-
-WICHTIG:
-- Lies JEDES Dokument VOLLSTÄNDIG durch
-- Scrolle durch ALLE Seiten in JEDEM PDF
-- Achte auf die RICHTIGE Spalte (meist "Politische Gemeinde")
-- Bei FiBu-Auszügen: Nimm den ENDSALDO, nicht Startsaldo
-- Prüfe deine Berechnungen DOPPELT
-
-Wenn du unsicher bist, sage es. Lieber einmal mehr prüfen als falsche Zahlen liefern."""
-
-            response = anthropic_client.messages.create(
+            response = await create_claude_message(
                 model=model_name,
                 max_tokens=8000,
-                system=system_prompt,
+                betas=[FILES_API_BETA],
+                system=ANALYSIS_SYSTEM_PROMPT,
+                tools=[AUDIT_TOOL],
+                tool_choice={"type": "tool", "name": AUDIT_TOOL["name"]},
                 messages=[{
                     "role": "user",
                     "content": content
                 }]
             )
             
-            response_text = response.content[0].text
-        
-        print(f"LLM response received ({len(response_text)} chars)")
+            # Forced tool use: the input is already a parsed dict
+            result = next(block.input for block in response.content if block.type == "tool_use")
+            log_claude_usage(response)
         
-        # Parse JSON from response
-        json_match = re.search(r'```json\s*([\s\S]*?)\s*```', response_text)
-        if json_match:
-            result = json.loads(json_match.group(1))
-        else:
-            # Try to find raw JSON
-            json_match = re.search(r'\{[\s\S]*\}', response_text)
-            if json_match:
-                result = json.loads(json_match.group(0))
-            else:
-                print(f"Could not parse JSON from response: {response_text[:200]}")
-                result = {
-                    "organization_name": "Unbekannt",
-                    "documents": [],
-                    "r805_result": {"status": "NO_DATA"},
-                    "r806_result": {"status": "NO_DATA"},
-                    "findings": ["Analyse konnte nicht abgeschlossen werden"],
-                    "recommendations": []
-                }
+        if cache_key:
+            store_cached_lookup("analysis", cache_key, result)
+            await run_blocking(store_cached_analysis, cache_key, model, result)
         
-        print(f"Analysis complete: {result.get('organization_name', 'Unknown')}")
+        logger.info("Analysis complete: %s", result.get('organization_name', 'Unknown'))
         return result
         
     except Exception as e:
-        print(f"LLM Analysis error: {e}")
+        logger.error("LLM Analysis error: %s", e)
         return {
             "organization_name": "Fehler",
             "documents": [],
@@ -504,81 +1388,56 @@ Wenn du unsicher bist, sage es. Lieber einmal mehr prüfen als falsche Zahlen li
         }
 
 
-def build_audit_results(llm_result: dict) -> List[AuditResult]:
-    """Convert LLM analysis result to AuditResult objects."""
-    results = []
-    
-    # R805 - Steuerforderungen
-    r805 = llm_result.get("r805_result", {})
-    tax_items_805 = [
-        TaxItem(
-            year=item.get("year", "Unknown"),
-            amount=item.get("amount", 0),
-            source=item.get("source", ""),
-            label=f"Total Restanzen ({item.get('type', 'Tax')})",
-            doc_type=item.get("type", "Tax")
-        )
-        for item in r805.get("tax_items", [])
-    ]
-    fibu_items_805 = [
-        FibuItem(
-            account=item.get("account", "1012.00"),
-            amount=item.get("amount", 0),
-            source=item.get("source", ""),
-            label="Kontoauszug Saldo"
-        )
-        for item in r805.get("fibu_items", [])
-    ]
-    
-    results.append(AuditResult(
+# (rule, result key, default FiBu account, description)
+AUDIT_RULES = [
+    ("R805", "r805_result", "1012.00", "Steuerforderungen (Konto 1012.00) vs. Steuerabrechnungen (positive Restanzen)"),
+    ("R806", "r806_result", "2002.00", "Steuerverpflichtungen (Konto 2002.00) vs. Steuerabrechnungen (negative Restanzen)"),
+]
+
+
+def build_rule_result(rule: str, rule_result: dict, default_account: str, description: str) -> AuditResult:
+    """Convert one rule's part of the LLM result into an AuditResult."""
+    tax_items = TAX_ITEMS_ADAPTER.validate_python([
+        {
+            "year": item.get("year", "Unknown"),
+            "amount": item.get("amount", 0),
+            "source": item.get("source", ""),
+            "label": f"Total Restanzen ({item.get('type', 'Tax')})",
+            "doc_type": item.get("type", "Tax")
+        }
+        for item in rule_result.get("tax_items", [])
+    ])
+    fibu_items = FIBU_ITEMS_ADAPTER.validate_python([
+        {
+            "account": item.get("account", default_account),
+            "amount": item.get("amount", 0),
+            "source": item.get("source", ""),
+            "label": "Kontoauszug Saldo"
+        }
+        for item in rule_result.get("fibu_items", [])
+    ])
+    status = rule_result.get("status", "NO_DATA")
+    difference = rule_result.get("difference", 0)
+    return AuditResult(
         summary=AuditSummary(
-            rule="R805",
-            description="Steuerforderungen (Konto 1012.00) vs. Steuerabrechnungen (positive Restanzen)",
-            status=r805.get("status", "NO_DATA"),
-            difference=r805.get("difference", 0),
-            tax_total=r805.get("tax_total"),
-            fibu_total=r805.get("fibu_total"),
-            hint=f"Differenz von CHF {r805.get('difference', 0):,.2f}" if r805.get("status") == "MISMATCH" else None
+            rule=rule,
+            description=description,
+            status=status,
+            difference=difference,
+            tax_total=rule_result.get("tax_total"),
+            fibu_total=rule_result.get("fibu_total"),
+            hint=f"Differenz von CHF {difference:,.2f}" if status == "MISMATCH" else None
         ),
-        details=AuditDetails(tax_items=tax_items_805, fibu_items=fibu_items_805)
-    ))
-    
-    # R806 - Steuerverpflichtungen
-    r806 = llm_result.get("r806_result", {})
-    tax_items_806 = [
-        TaxItem(
-            year=item.get("year", "Unknown"),
-            amount=item.get("amount", 0),
-            source=item.get("source", ""),
-            label=f"Total Restanzen ({item.get('type', 'Tax')})",
-            doc_type=item.get("type", "Tax")
-        )
-        for item in r806.get("tax_items", [])
-    ]
-    fibu_items_806 = [
-        FibuItem(
-            account=item.get("account", "2002.00"),
-            amount=item.get("amount", 0),
-            source=item.get("source", ""),
-            label="Kontoauszug Saldo"
-        )
-        for item in r806.get("fibu_items", [])
+        details=AuditDetails(tax_items=tax_items, fibu_items=fibu_items)
+    )
+
+
+def build_audit_results(llm_result: dict) -> List[AuditResult]:
+    """Convert LLM analysis result to AuditResult objects."""
+    return [
+        build_rule_result(rule, llm_result.get(key, {}), default_account, description)
+        for rule, key, default_account, description in AUDIT_RULES
     ]
-    
-    results.append(AuditResult(
-        summary=AuditSummary(
-            rule="R806",
-            description="Steuerverpflichtungen (Konto 2002.00) vs. Steuerabrechnungen (negative Restanzen)",
-            status=r806.get("status", "NO_DATA"),
-            difference=r806.get("difference", 0),
-            tax_total=r806.get("tax_total"),
-            fibu_total=r806.get("fibu_total"),
-            hint=f"Differenz von CHF {r806.get('difference', 0):,.2f}" if r806.get("status") == "MISMATCH" else None
-        ),
-        details=AuditDetails(tax_items=tax_items_806, fibu_items=fibu_items_806)
-    ))
-    
-    return results
 
 
 # ============== API Endpoints ==============
@@ -589,6 +1448,37 @@ async def root():
     return {"status": "ok", "service": "Revipro Reconciliation Engine", "version": "6.0.0", "ai_only": True}
 
 
+async def mark_session_analyzed(session_id: str, organization_name: str) -> None:
+    """Update the sessions row once the analysis is done."""
+    try:
+        await run_blocking(get_supabase().table("sessions").update({
+            "organization_type": organization_name,
+            "status": "analyzed"
+        }).eq("id", session_id).execute)
+        await invalidate_session_list()
+    except Exception as e:
+        logger.error("Session update error: %s", e)
+
+
+def model_response(model: BaseModel) -> Response:
+    """Serialize a response model once in pydantic-core, skipping FastAPI's re-validation and jsonable_encoder."""
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
+async def create_session_row() -> str:
+    """Insert a new active session and return its id."""
+    # Generated here so the insert does not depend on a column default on sessions.id
+    session_id = str(uuid.uuid4())
+    try:
+        await run_blocking(get_supabase().table("sessions").insert({"id": session_id, "status": "active"}).execute)
+        await invalidate_session_list()
+        return session_id
+    except Exception as e:
+        # Keep the request usable with a local id, as before, even if the row could not be written
+        logger.error("Session creation error: %s", e)
+        return session_id
+
+
 @app.post("/analyze", response_model=AnalysisResponse)
 async def analyze_files(
     files: List[UploadFile] = File(...),
@@ -605,53 +1495,38 @@ async def analyze_files(
     """
     start_time = time.time()
     
-    print(f"\n{'='*60}")
-    print(f"Received {len(files)} files for analysis")
-    
-    # Generate session ID
-    session_id = str(uuid.uuid4())
+    logger.info("Received %s files for analysis", len(files))
     
     # Create session in Supabase first
-    try:
-        supabase.table("sessions").insert({
-            "id": session_id,
-            "status": "active"
-        }).execute()
-    except Exception as e:
-        print(f"Session creation error: {e}")
+    session_id = await create_session_row()
     
-    # Upload all PDFs to Supabase
-    uploaded_count = 0
+    # Upload all PDFs to Supabase concurrently, metadata in a single insert
+    pdf_files = []
     for file in files:
         if not file.filename.lower().endswith('.pdf'):
-            print(f"  Skipping non-PDF: {file.filename}")
+            logger.debug("Skipping non-PDF: %s", file.filename)
             continue
-        
-        file_bytes = await file.read()
-        print(f"  Uploading: {file.filename} ({len(file_bytes)} bytes)")
-        
-        result = save_document_to_supabase(session_id, file.filename, file_bytes)
-        if result:
-            uploaded_count += 1
+        pdf_files.append(file)
     
-    print(f"Uploaded {uploaded_count} PDFs to Supabase")
+    # Only Claude reads PDFs by Files API id; Gemini runs skip that upload
+    uploaded_count = await save_documents_to_supabase(session_id, pdf_files, not is_gemini_model(model))
     
-    # Wait for Supabase to fully commit the uploads
-    await asyncio.sleep(1.5)
+    logger.info("Uploaded %s PDFs to Supabase", uploaded_count)
     
-    # Verify uploads are accessible
+    # Verify uploads are accessible (uploads and the metadata insert were awaited, so no fixed delay)
     pdf_urls = await get_session_pdf_urls(session_id)
-    print(f"Verified {len(pdf_urls)} PDFs accessible in Supabase")
+    logger.info("Verified %s PDFs accessible in Supabase", len(pdf_urls))
     
     # If not all uploaded, wait and retry
     if len(pdf_urls) < uploaded_count:
-        print(f"  Waiting for remaining uploads...")
+        logger.info("Waiting for remaining uploads...")
         await asyncio.sleep(2.0)
+        forget_cached_lookup("documents", session_id)
         pdf_urls = await get_session_pdf_urls(session_id)
-        print(f"  Now {len(pdf_urls)} PDFs accessible")
+        logger.info("Now %s PDFs accessible", len(pdf_urls))
     
     if uploaded_count == 0:
-        return AnalysisResponse(
+        return model_response(AnalysisResponse(
             results=[],
             files_processed=0,
             session_id=session_id,
@@ -661,7 +1536,7 @@ async def analyze_files(
                 recommendations=["Bitte laden Sie PDF-Dateien hoch"],
                 confidence="low"
             )
-        )
+        ))
     
     # Analyze with LLM
     llm_result = await analyze_pdfs_with_llm(session_id, model)
@@ -671,8 +1546,9 @@ async def analyze_files(
     
     # Count document types from LLM result
     documents = llm_result.get("documents", [])
-    tax_count = len([d for d in documents if d.get("type") in ["JA", "SR", "NAST"]])
-    fibu_count = len([d for d in documents if d.get("type") == "FiBu"])
+    type_counts = Counter(d.get("type") for d in documents)
+    tax_count = type_counts["JA"] + type_counts["SR"] + type_counts["NAST"]
+    fibu_count = type_counts["FiBu"]
     
     # Create AI insight
     ai_insight = AIInsight(
@@ -682,27 +1558,22 @@ async def analyze_files(
         confidence="high" if documents else "low"
     )
     
-    # Store session context
-    chat_sessions[session_id] = {
-        "messages": [],
-        "llm_result": llm_result,
-        "organization_name": llm_result.get("organization_name", "Steuerprüfung"),
-        "created_at": datetime.now()
-    }
-    
-    # Update session in Supabase
-    try:
-        supabase.table("sessions").update({
-            "organization_type": llm_result.get("organization_name", "Steuerprüfung"),
-            "status": "analyzed"
-        }).eq("id", session_id).execute()
-    except Exception as e:
-        print(f"Session update error: {e}")
+    # Store session context and mark the session analyzed concurrently
+    organization_name = llm_result.get("organization_name", "Steuerprüfung")
+    await asyncio.gather(
+        save_chat_session(session_id, {
+            "messages": [],
+            "llm_result": llm_result,
+            "organization_name": organization_name,
+            "created_at": time.time()
+        }),
+        mark_session_analyzed(session_id, organization_name)
+    )
     
     duration = time.time() - start_time
-    print(f"Analysis complete in {duration:.1f}s")
+    logger.info("Analysis complete in %.1fs", duration)
     
-    return AnalysisResponse(
+    return model_response(AnalysisResponse(
         results=audit_results,
         files_processed=uploaded_count,
         tax_files=tax_count,
@@ -710,124 +1581,329 @@ async def analyze_files(
         annual_report_files=0,
         ai_insight=ai_insight,
         session_id=session_id
+    ))
+
+
+# ============== Chat Helper Functions ==============
+
+# Messages that refer to the documents; other follow-ups are answered without re-attaching the PDFs
+PDF_KEYWORDS_RE = re.compile(
+    r'\b(pdf|dokument|datei|lies|lese|prüf|konto|jahresabrechnung|restanz|zeile|spalte|seite'
+    r'|differenz|abweichung|saldo|betrag|detail'
+    r'|r\d{3}|\d{4}\.\d{2}|20\d{2})',  # rule ids (R806), accounts (1012.00), years (2024)
+    re.IGNORECASE
+)
+
+# Replies that talk about a discrepancy get drill-down suggestions
+DIFFERENCE_KEYWORDS_RE = re.compile(r'differenz|abweichung', re.IGNORECASE)
+
+
+def needs_documents(session: Dict, message: str) -> bool:
+    """Attach the PDFs on the first turn, when the message is about the documents or figures,
+    or when the previous reply was about a discrepancy (its drill-down suggestions need them)."""
+    messages = session["messages"]
+    user_turns = sum(1 for msg in messages if msg["role"] == "user")
+    if user_turns <= 1 or PDF_KEYWORDS_RE.search(message):
+        return True
+    previous = messages[-2] if len(messages) >= 2 else None
+    return previous is not None and previous["role"] == "assistant" and bool(
+        DIFFERENCE_KEYWORDS_RE.search(previous["content"])
     )
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat_with_ai(request: ChatRequest):
-    """
-    Chat with AI about the audit results.
-    The AI always has access to the original PDFs via signed URLs.
+async def prepare_chat(request: ChatRequest) -> tuple:
+    """Load the session, record the user message and build the system prompt.
+
+    Returns (session, system_prompt, pdf_urls, repeated_reply). repeated_reply is set, and
+    nothing else is prepared, when the same question is sent again to the same model within
+    RESUBMIT_WINDOW_SECONDS of its answer. Duplicates that arrive while the first request is
+    still running are shared in /chat via single_flight instead.
     """
     session_id = request.session_id
     
-    print(f"\n{'='*60}")
-    print(f"Chat request for session: {session_id}")
-    print(f"Message: {request.message[:100]}...")
-    print(f"Model: {request.model}")
-    
     # Get or create session
-    if session_id not in chat_sessions:
-        chat_sessions[session_id] = {
+    session = await load_chat_session(session_id)
+    if session is None:
+        session = {
             "messages": [],
             "llm_result": {},
-            "created_at": datetime.now()
+            "created_at": time.time()
         }
     
-    session = chat_sessions[session_id]
+    # Double submit of the question just answered: reuse that answer
+    now = time.time()
+    last_turn = session["messages"][-2:]
+    if (len(last_turn) == 2 and last_turn[0]["role"] == "user" and last_turn[1]["role"] == "assistant"
+            and last_turn[0]["content"] == request.message
+            and last_turn[0].get("model") == request.model
+            and now - last_turn[1].get("answered_at", 0) <= RESUBMIT_WINDOW_SECONDS
+            and last_turn[1]["content"]):
+        return session, "", [], last_turn[1]["content"]
     
     # Add user message to history
     session["messages"].append({
         "role": "user",
-        "content": request.message
+        "content": request.message,
+        "model": request.model
     })
     
-    # Get PDF URLs for this session
-    pdf_urls = await get_session_pdf_urls(session_id)
-    
-    # Get client knowledge if available
+    # Fetch PDF URLs (skipped for purely conversational follow-ups) and client knowledge concurrently
     org_name = session.get("organization_name", "")
-    client_knowledge = await get_client_knowledge(org_name) if org_name else {}
+    attach_documents = needs_documents(session, request.message)
+    pdf_urls, client_knowledge = await asyncio.gather(
+        get_session_pdf_urls(session_id) if attach_documents else asyncio.sleep(0, []),
+        get_client_knowledge(org_name) if org_name else asyncio.sleep(0, {})
+    )
+    
+    # Build system prompt: static base plus per-session context
+    parts = [CHAT_SYSTEM_PROMPT]
+    
+    # Add client knowledge
+    if client_knowledge:
+        parts.append(f"\n\n## CLIENT-WISSEN für {org_name}:\n")
+        parts.extend(
+            f"• Spalte: {pref.get('column_name', 'Unbekannt')}\n"
+            for pref in client_knowledge.get("column_preferences", [])
+        )
+    
+    # Add previous analysis context
+    if session.get("llm_result"):
+        llm_result = session["llm_result"]
+        parts.append("\n\n## LETZTE ANALYSE:\n")
+        parts.append(f"Organisation: {llm_result.get('organization_name', 'Unbekannt')}\n")
+        parts.extend(f"• {finding}\n" for finding in llm_result.get("findings", [])[:5])
     
-    # Build system prompt
-    system_prompt = """Du bist ein Experte für Schweizer Gemeindesteuerprüfung.
+    # Add summary of older turns that are no longer sent verbatim
+    if session.get("summary"):
+        parts.append(f"\n\n## BISHERIGES GESPRÄCH (Zusammenfassung):\n{session['summary']}\n")
+    
+    # The base prompt promises the PDFs; say so when this turn was answered without them
+    if not attach_documents:
+        parts.append(
+            "\n\n## HINWEIS:\nFür diese Nachricht sind die PDFs NICHT angehängt. "
+            "Nenne keine Zahlen aus den Dokumenten, die nicht oben oder im bisherigen Gespräch stehen. "
+            "Wenn du die Dokumente brauchst, bitte den Benutzer, danach zu fragen (z.B. \"Prüfe die Dokumente nochmal\").\n"
+        )
+    
+    system_prompt = "".join(parts)
+    
+    return session, system_prompt, pdf_urls, None
 
-Du hast Zugriff auf die hochgeladenen PDF-Dokumente und kannst sie jederzeit lesen.
 
-## DEIN FACHWISSEN:
+async def build_gemini_parts(system_prompt: str, session: Dict, pdf_urls: List[dict]) -> list:
+    """Build Gemini content parts: the session PDFs followed by the conversation."""
+    gemini_parts = []
+    
+    # Add PDFs
+    blobs = await download_pdfs([pdf["file_path"] for pdf in pdf_urls[:10]])  # Limit to 10 PDFs
+    for file_bytes in blobs:
+        if file_bytes:
+            gemini_parts.append(gemini_pdf_part(file_bytes))
+    
+    # Add conversation
+    gemini_prompt = system_prompt + "\n\n---\n\nKonversation:\n\n"
+    for msg in session["messages"]:
+        role = "User" if msg["role"] == "user" else "Assistant"
+        gemini_prompt += f"{role}: {msg['content']}\n\n"
+    
+    gemini_parts.append(gemini_prompt)
+    return gemini_parts
 
-### Dokumenttypen:
-- **JA (Jahresabrechnung)**: Zeile 45 "Total Restanzen" = SOLL-Buchung
-- **SR (Steuerrestanzen)**: Zeile 45 = HABEN (Auflösung), Zeile 51 = SOLL (neuer Stand)
-- **NAST (Nachsteuern)**: Zeile 38/44 "Total Restanzen"
 
-### Kontenlogik:
-- **Konto 1012.00**: POSITIVE Restanzen (Steuerforderungen)
-- **Konto 2002.00**: NEGATIVE Restanzen (als positiver Wert auf Passivseite)
+def build_claude_messages(session: Dict, pdf_urls: List[dict], message: str) -> List[dict]:
+    """Build Claude messages with the session PDFs attached to the first user message."""
+    messages = []
+    
+    # First message includes PDFs
+    # Cached after the first turn, so follow-up turns only pay for new tokens
+    first_content = mark_cache_breakpoint([document_block(pdf) for pdf in pdf_urls[:10]])  # Limit to 10 PDFs
+    
+    # Add conversation history
+    for i, msg in enumerate(session["messages"]):
+        if i == 0 and msg["role"] == "user":
+            # First user message includes PDFs
+            first_content.append({
+                "type": "text",
+                "text": msg["content"]
+            })
+            messages.append({
+                "role": "user",
+                "content": first_content
+            })
+        else:
+            messages.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+    
+    # If no messages yet, add PDFs with current message
+    if not messages:
+        first_content.append({
+            "type": "text",
+            "text": message
+        })
+        messages = [{"role": "user", "content": first_content}]
+    
+    return messages
 
-### Spalten:
-- Gemeinden: "Politische Gemeinde"
-- Kirchen: "ref. Kirche" oder "kath. Kirche"
-- Schulen: "Sekundarschule"
 
-## KOMMUNIKATION:
-- Antworte IMMER auf Deutsch
-- KEINE Markdown-Headers (##, ###)
-- Schreibe natürlichen Fliesstext
-- Für Listen: • oder - am Zeilenanfang
-- Zahlen: CHF X'XXX.XX
-- Kurz und prägnant (max 3-4 Absätze)
+pending_tasks: set = set()  # strong refs so fire-and-forget tasks are not garbage collected
 
-## WICHTIG:
-Wenn der Benutzer fragt "lies nochmal" oder "prüfe nochmals", dann LESE die PDFs erneut und extrahiere die Daten frisch.
-Du hast IMMER Zugriff auf die Original-PDFs!
-"""
 
-    # Add client knowledge
-    if client_knowledge:
-        system_prompt += f"\n\n## CLIENT-WISSEN für {org_name}:\n"
-        for pref in client_knowledge.get("column_preferences", []):
-            system_prompt += f"• Spalte: {pref.get('column_name', 'Unbekannt')}\n"
+def run_in_background(coro) -> None:
+    """Start a task that outlives the request without blocking its response."""
+    task = asyncio.ensure_future(coro)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+
+
+def fold_old_messages(session: Dict) -> None:
+    """Move messages outside the recent window to session["unsummarized"] until the summary picks them up."""
+    kept = trim_history(session["messages"], SUMMARY_KEEP_MESSAGES)
+    dropped = session["messages"][:len(session["messages"]) - len(kept)]
+    if not dropped:
+        return
+    # Capped so repeated summary failures can't grow the session without bound
+    session["unsummarized"] = (session.get("unsummarized", []) + dropped)[-SESSION_MAX_MESSAGES:]
+    session["messages"] = kept
+
+
+async def summarize_history(session_id: str) -> None:
+    """Fold the session's unsummarized messages into session["summary"] using a small model."""
+    session = await load_chat_session(session_id)
+    pending = (session or {}).get("unsummarized")
+    if not pending:
+        return
+    transcript = "\n\n".join(
+        f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}" for msg in pending
+    )
+    prompt = (
+        "Fasse dieses Gespräch über eine Schweizer Gemeindesteuerprüfung in max. 10 Stichpunkten zusammen. "
+        "Behalte alle Zahlen, Konten, Jahre und Entscheidungen des Benutzers.\n\n"
+    )
+    if session.get("summary"):
+        prompt += f"Bisherige Zusammenfassung:\n{session['summary']}\n\n"
+    prompt += f"Neue Nachrichten:\n{transcript}"
     
-    # Add previous analysis context
-    if session.get("llm_result"):
-        llm_result = session["llm_result"]
-        system_prompt += f"\n\n## LETZTE ANALYSE:\n"
-        system_prompt += f"Organisation: {llm_result.get('organization_name', 'Unbekannt')}\n"
-        for finding in llm_result.get("findings", [])[:5]:
-            system_prompt += f"• {finding}\n"
+    try:
+        response = await create_claude_message(
+            model=SUMMARY_MODEL,
+            max_tokens=800,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        # Apply to the latest copy: another turn may have been saved while the summary ran
+        latest = await load_chat_session(session_id)
+        if latest is None:
+            return
+        latest["summary"] = response.content[0].text
+        latest["unsummarized"] = latest.get("unsummarized", [])[len(pending):]
+        await save_chat_session(session_id, latest)
+    except Exception as e:
+        logger.error("History summary error: %s", e)
+
+
+async def finish_chat(session_id: str, session: Dict, user_message: str, assistant_message: str) -> List[str]:
+    """Store the assistant reply, queue both messages for Supabase and return follow-up suggestions."""
+    # Add assistant message to history
+    session["messages"].append({
+        "role": "assistant",
+        "content": assistant_message,
+        "answered_at": time.time()
+    })
+    needs_summary = (len(session["messages"]) > SESSION_MAX_MESSAGES
+                     or history_chars(session["messages"]) > SESSION_MAX_HISTORY_CHARS)
+    if needs_summary:
+        fold_old_messages(session)
+    await save_chat_session(session_id, session)
+    if session.get("unsummarized"):
+        # The summary is only needed from the next turn on, so don't make this reply wait for it
+        run_in_background(single_flight(f"summary:{session_id}", lambda: summarize_history(session_id)))
+    
+    # Save to Supabase in background (batched by the writer task)
+    await enqueue_insert(
+        "chat_messages",
+        {"session_id": session_id, "role": "user", "content": user_message},
+        {"session_id": session_id, "role": "assistant", "content": assistant_message}
+    )
+    
+    return chat_suggestions(assistant_message)
+
+
+def chat_suggestions(assistant_message: str) -> List[str]:
+    """Pick follow-up suggestions for an assistant reply."""
+    if DIFFERENCE_KEYWORDS_RE.search(assistant_message):
+        return ["Woher kommt diese Differenz?", "Zeige mir die Details", "Was soll ich prüfen?"]
+    elif "?" in assistant_message:
+        return ["Ja, das ist korrekt", "Nein, lass mich erklären", "Lies die PDFs nochmal"]
+    return ["Erkläre das genauer", "Prüfe die Dokumente nochmal", "Was sind die nächsten Schritte?"]
+
+
+async def stream_claude_text(model_name: str, system_prompt: str, messages: List[dict]):
+    """Yield Claude response text as it is generated."""
+    # A stream can't be retried from outside once text has been sent, so let the SDK retry the request itself
+    async with get_llm_semaphore():
+        async with get_anthropic_client().with_options(max_retries=2).beta.messages.stream(
+            model=model_name,
+            max_tokens=2000,
+            betas=[FILES_API_BETA],
+            system=system_prompt,
+            messages=messages
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+
+
+async def stream_gemini_text(gemini_model: str, gemini_parts: list):
+    """Yield Gemini response text as it is generated."""
+    async with get_llm_semaphore():
+        async for chunk in await get_gemini_client().aio.models.generate_content_stream(
+            model=gemini_model,
+            contents=gemini_parts
+        ):
+            text = getattr(chunk, "text", "") or ""
+            if text:
+                yield text
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Format a server-sent event with a JSON payload."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat_with_ai(request: ChatRequest):
+    """
+    Chat with AI about the audit results.
+    The AI always has access to the original PDFs via signed URLs.
+    """
+    logger.info("Chat request for session: %s (model: %s)", request.session_id, request.model)
+    logger.debug("Message: %s...", request.message[:100])
+    
+    # A double submit that arrives while the first one is still running shares its answer
+    message_hash = hashlib.blake2b(request.message.encode(), digest_size=16).hexdigest()
+    flight_key = f"chat:{request.session_id}:{request.model}:{message_hash}"
+    return await single_flight(flight_key, lambda: answer_chat(request))
+
+
+async def answer_chat(request: ChatRequest) -> ChatResponse:
+    """Run one /chat turn: prepare the context, call the model and store the reply."""
+    session_id = request.session_id
+    session, system_prompt, pdf_urls, repeated_reply = await prepare_chat(request)
+    if repeated_reply is not None:
+        return ChatResponse(
+            response=repeated_reply,
+            session_id=session_id,
+            suggestions=chat_suggestions(repeated_reply)
+        )
     
     try:
-        if request.model in ["gemini-pro", "gemini-flash"]:
+        if is_gemini_model(request.model):
             # Use Gemini
-            gemini_model = "gemini-3-pro-preview" if request.model == "gemini-pro" else "gemini-3-flash-preview"
-            
-            # Build content with PDFs
-            gemini_parts = []
+            gemini_parts = await build_gemini_parts(system_prompt, session, pdf_urls)
             
-            # Add PDFs
-            for pdf in pdf_urls[:10]:  # Limit to 10 PDFs
-                try:
-                    file_bytes = supabase.storage.from_("documents").download(pdf["file_path"])
-                    if file_bytes:
-                        part = google_genai.types.Part.from_bytes(
-                            data=file_bytes,
-                            mime_type="application/pdf"
-                        )
-                        gemini_parts.append(part)
-                except Exception as e:
-                    print(f"Error loading PDF for Gemini: {e}")
-            
-            # Add conversation
-            gemini_prompt = system_prompt + "\n\n---\n\nKonversation:\n\n"
-            for msg in session["messages"]:
-                role = "User" if msg["role"] == "user" else "Assistant"
-                gemini_prompt += f"{role}: {msg['content']}\n\n"
-            
-            gemini_parts.append(gemini_prompt)
-            
-            response = gemini_client.models.generate_content(
-                model=gemini_model,
+            response = await generate_gemini_content(
+                model=gemini_model_name(request.model),
                 contents=gemini_parts
             )
             
@@ -839,89 +1915,18 @@ Du hast IMMER Zugriff auf die Original-PDFs!
                 ])
         else:
             # Use Claude
-            model_name = "claude-opus-4-5" if request.model == "opus" else "claude-sonnet-4-5"
-            
-            # Build messages with PDFs in the first user message
-            messages = []
-            
-            # First message includes PDFs
-            first_content = []
-            for pdf in pdf_urls[:10]:  # Limit to 10 PDFs
-                first_content.append({
-                    "type": "document",
-                    "source": {
-                        "type": "url",
-                        "url": pdf["url"]
-                    }
-                })
-            
-            # Add conversation history
-            for i, msg in enumerate(session["messages"]):
-                if i == 0 and msg["role"] == "user":
-                    # First user message includes PDFs
-                    first_content.append({
-                        "type": "text",
-                        "text": msg["content"]
-                    })
-                    messages.append({
-                        "role": "user",
-                        "content": first_content
-                    })
-                else:
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
-            
-            # If no messages yet, add PDFs with current message
-            if not messages:
-                first_content.append({
-                    "type": "text",
-                    "text": request.message
-                })
-                messages = [{"role": "user", "content": first_content}]
-            
-            response = anthropic_client.messages.create(
-                model=model_name,
+            response = await create_claude_message(
+                model=claude_model_name(request.model),
                 max_tokens=2000,
+                betas=[FILES_API_BETA],
                 system=system_prompt,
-                messages=messages
+                messages=build_claude_messages(session, pdf_urls, request.message)
             )
             
             assistant_message = response.content[0].text
+            log_claude_usage(response)
         
-        # Add assistant message to history
-        session["messages"].append({
-            "role": "assistant",
-            "content": assistant_message
-        })
-        
-        # Save to Supabase in background
-        def save_chat():
-            try:
-                supabase.table("chat_messages").insert({
-                    "session_id": session_id,
-                    "role": "user",
-                    "content": request.message
-                }).execute()
-                supabase.table("chat_messages").insert({
-                    "session_id": session_id,
-                    "role": "assistant",
-                    "content": assistant_message
-                }).execute()
-            except Exception as e:
-                print(f"Chat save error: {e}")
-        
-        threading.Thread(target=save_chat, daemon=True).start()
-        
-        # Generate suggestions
-        suggestions = []
-        if "differenz" in assistant_message.lower() or "abweichung" in assistant_message.lower():
-            suggestions = ["Woher kommt diese Differenz?", "Zeige mir die Details", "Was soll ich prüfen?"]
-        elif "?" in assistant_message:
-            suggestions = ["Ja, das ist korrekt", "Nein, lass mich erklären", "Lies die PDFs nochmal"]
-        else:
-            suggestions = ["Erkläre das genauer", "Prüfe die Dokumente nochmal", "Was sind die nächsten Schritte?"]
+        suggestions = await finish_chat(session_id, session, request.message, assistant_message)
         
         return ChatResponse(
             response=assistant_message,
@@ -930,7 +1935,7 @@ Du hast IMMER Zugriff auf die Original-PDFs!
         )
         
     except Exception as e:
-        print(f"Chat error: {e}")
+        logger.error("Chat error: %s", e)
         return ChatResponse(
             response=f"Entschuldigung, es gab einen Fehler: {str(e)[:100]}. Bitte versuchen Sie es erneut.",
             session_id=session_id,
@@ -938,52 +1943,212 @@ Du hast IMMER Zugriff auf die Original-PDFs!
         )
 
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Same as /chat, but streams the answer as server-sent events.
+    Emits `data: {"text": ...}` chunks and a final `done` event with suggestions.
+    """
+    session_id = request.session_id
+    logger.info("Chat stream request for session: %s (model: %s)", session_id, request.model)
+    
+    session, system_prompt, pdf_urls, repeated_reply = await prepare_chat(request)
+    if repeated_reply is not None:
+        async def repeated_stream():
+            yield sse_event({"text": repeated_reply})
+            yield sse_event({"session_id": session_id, "suggestions": chat_suggestions(repeated_reply)}, event="done")
+        return StreamingResponse(repeated_stream(), media_type="text/event-stream")
+    
+    if is_gemini_model(request.model):
+        gemini_parts = await build_gemini_parts(system_prompt, session, pdf_urls)
+        text_stream = stream_gemini_text(gemini_model_name(request.model), gemini_parts)
+    else:
+        messages = build_claude_messages(session, pdf_urls, request.message)
+        text_stream = stream_claude_text(claude_model_name(request.model), system_prompt, messages)
+    
+    async def event_stream():
+        chunks = []
+        try:
+            async for text in text_stream:
+                chunks.append(text)
+                yield sse_event({"text": text})
+            suggestions = await finish_chat(session_id, session, request.message, "".join(chunks))
+            yield sse_event({"session_id": session_id, "suggestions": suggestions}, event="done")
+        except Exception as e:
+            logger.error("Chat stream error: %s", e)
+            yield sse_event({"message": str(e)[:100]}, event="error")
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 # ============== Session Management Endpoints ==============
 
+def service_unavailable(body: dict) -> ORJSONResponse:
+    """503 for transient Supabase failures: clients retry shortly and nothing caches the body."""
+    return ORJSONResponse(body, status_code=503, headers={"Retry-After": "1", "Cache-Control": "no-store"})
+
+
+SESSION_LIST_TTL_SECONDS = 10  # Dashboard polls within this window are served from cache
+SESSION_LIST_CACHE_KEY = "sessions:list:v1"
+session_list_cache: Optional[tuple] = None  # (expires_at, sessions) when Redis is not configured
+
+
+async def get_cached_session_list() -> Optional[List[dict]]:
+    """Return the cached session list if it has not expired."""
+    if redis_client is not None:
+        try:
+            raw = await redis_client.get(SESSION_LIST_CACHE_KEY)
+            return orjson.loads(raw) if raw else None
+        except Exception as e:
+            logger.warning("Session list cache read error: %s", e)
+            return None
+    if session_list_cache and session_list_cache[0] > time.monotonic():
+        return session_list_cache[1]
+    return None
+
+
+async def store_session_list(sessions: List[dict]) -> None:
+    """Cache the session list for a few seconds."""
+    global session_list_cache
+    if redis_client is not None:
+        try:
+            await redis_client.setex(SESSION_LIST_CACHE_KEY, SESSION_LIST_TTL_SECONDS, orjson.dumps(sessions))
+        except Exception as e:
+            logger.warning("Session list cache write error: %s", e)
+    else:
+        session_list_cache = (time.monotonic() + SESSION_LIST_TTL_SECONDS, sessions)
+
+
+async def invalidate_session_list() -> None:
+    """Drop the cached session list after a session was created, changed or deleted."""
+    global session_list_cache
+    session_list_cache = None
+    if redis_client is not None:
+        try:
+            await redis_client.delete(SESSION_LIST_CACHE_KEY)
+        except Exception as e:
+            logger.warning("Session list cache invalidation error: %s", e)
+
+
+async def count_session_documents(session_id: str) -> int:
+    """Count the documents of one session (fallback when embedded counts are unavailable)."""
+    # head=True: PostgREST answers with the count header only, no rows
+    query = get_supabase().table("documents").select("id", count="exact", head=True).eq("session_id", session_id)
+    result = await run_blocking(query.execute)
+    return result.count or 0
+
+
+SESSIONS_WITH_COUNTS_SQL = """
+    select s.id, s.created_at, s.status, s.organization_type, count(d.id) as document_count
+    from sessions s left join documents d on d.session_id = s.id
+    group by s.id
+    order by s.created_at desc
+    limit 50
+"""
+
+
+async def fetch_sessions_with_counts() -> List[dict]:
+    """Fetch recent sessions with their document counts, in one query when possible."""
+    if db_pool is not None:
+        try:
+            async with db_pool.acquire() as conn:
+                records = await conn.fetch(SESSIONS_WITH_COUNTS_SQL)
+            return [{**dict(record), "id": str(record["id"])} for record in records]
+        except Exception as e:
+            logger.warning("Direct session query failed, using PostgREST: %s", e)
+    try:
+        # Embedded count: PostgREST aggregates documents per session in the same query
+        query = (
+            get_supabase().table("sessions")
+            .select("id, created_at, status, organization_type, documents(count)")
+            .order("created_at", desc=True)
+            .limit(50)
+        )
+        result = await run_blocking(query.execute)
+        rows = result.data or []
+        for row in rows:
+            doc_counts = row.pop("documents", None) or [{}]
+            row["document_count"] = doc_counts[0].get("count", 0)
+        return rows
+    except Exception as e:
+        # No sessions->documents relationship exposed: count per session, concurrently
+        logger.warning("Embedded document count failed, falling back to per-session counts: %s", e)
+        query = get_supabase().table("sessions").select("*").order("created_at", desc=True).limit(50)
+        result = await run_blocking(query.execute)
+        rows = result.data or []
+        counts = await asyncio.gather(*[count_session_documents(row["id"]) for row in rows])
+        for row, count in zip(rows, counts):
+            row["document_count"] = count
+        return rows
+
+
+async def load_session_list() -> List[dict]:
+    """Build the session list payload from Supabase and cache it."""
+    sessions = [
+        {
+            "id": session["id"],
+            "created_at": session["created_at"],
+            "status": session.get("status", "active"),
+            "organization_type": session.get("organization_type"),
+            "document_count": session["document_count"]
+        }
+        for session in await fetch_sessions_with_counts()
+    ]
+    await store_session_list(sessions)
+    return sessions
+
+
 @app.get("/sessions")
-async def list_sessions():
+async def list_sessions(request: Request):
     """Get all sessions from Supabase."""
     try:
-        result = supabase.table("sessions").select("*").order("created_at", desc=True).limit(50).execute()
-        sessions = []
-        for session in result.data or []:
-            docs = supabase.table("documents").select("id", count="exact").eq("session_id", session["id"]).execute()
-            sessions.append({
-                "id": session["id"],
-                "created_at": session["created_at"],
-                "status": session.get("status", "active"),
-                "organization_type": session.get("organization_type"),
-                "document_count": docs.count or 0
-            })
-        return {"sessions": sessions}
+        sessions = await get_cached_session_list()
+        if sessions is None:
+            sessions = await single_flight(SESSION_LIST_CACHE_KEY, load_session_list)
+        # ETag lets polling dashboards revalidate with a bodiless 304 when nothing changed
+        body = orjson.dumps({"sessions": sessions})
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
-        print(f"Error listing sessions: {e}")
-        return {"sessions": []}
+        logger.error("Error listing sessions: %s", e)
+        return service_unavailable({"sessions": []})
 
 
 @app.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
     """Delete a session and all related data."""
     try:
-        supabase.table("sessions").delete().eq("id", session_id).execute()
-        if session_id in chat_sessions:
-            del chat_sessions[session_id]
+        forget_cached_lookup("documents", session_id)
+        documents = await get_session_documents(session_id)
+        file_ids = [
+            (doc.get("extracted_data") or {}).get("anthropic_file_id") for doc in documents
+        ]
+        storage_paths = [doc["file_path"] for doc in documents if doc.get("file_path")]
+        # documents, chat_messages and activity_logs rows go with the session via ON DELETE CASCADE
+        # (see README). Delete the row first: if that fails, the files it points at must still exist.
+        await run_blocking(get_supabase().table("sessions").delete().eq("id", session_id).execute)
+        # The uploaded files live outside Postgres and are removed once the rows are gone
+        await asyncio.gather(
+            delete_from_storage(storage_paths),
+            *[delete_from_anthropic(file_id) for file_id in file_ids if file_id]
+        )
+        await invalidate_session_list()
+        forget_cached_lookup("documents", session_id)
+        await delete_chat_session(session_id)
+        forget_session_pdfs(session_id)
         return {"status": "ok"}
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        logger.error("Error deleting session %s: %s", session_id, e)
+        return service_unavailable({"status": "error", "message": str(e)})
 
 
 @app.post("/sessions/new")
 async def create_new_session():
     """Create a new empty session."""
-    session_id = str(uuid.uuid4())
-    try:
-        supabase.table("sessions").insert({
-            "id": session_id,
-            "status": "active"
-        }).execute()
-    except Exception as e:
-        print(f"Error creating session: {e}")
+    session_id = await create_session_row()
     return {"session_id": session_id}
 
 
@@ -991,58 +2156,123 @@ async def create_new_session():
 async def rename_session(session_id: str, organization_type: str = None):
     """Rename a session."""
     try:
-        supabase.table("sessions").update({"organization_type": organization_type}).eq("id", session_id).execute()
+        query = get_supabase().table("sessions").update({"organization_type": organization_type}).eq("id", session_id)
+        await run_blocking(query.execute)
+        await invalidate_session_list()
         return {"status": "ok"}
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        logger.error("Error renaming session %s: %s", session_id, e)
+        return service_unavailable({"status": "error", "message": str(e)})
 
 
 # ============== Logging Endpoint ==============
 
-class LogRequest(BaseModel):
+class LogRequest(msgspec.Struct, kw_only=True):
     session_id: Optional[str] = None
     event_type: str
     event_category: str
     data: Dict = {}
 
 
+# /log is hot: msgspec decodes and validates the body in one pass, skipping FastAPI's pydantic path
+LOG_REQUEST_DECODER = msgspec.json.Decoder(LogRequest)
+
+
+LOG_DATA_MAX_BYTES = 8 * 1024  # larger payloads get their long strings shortened
+LOG_STRING_MAX_CHARS = 1000
+
+
+def shorten_strings(value: Any) -> tuple:
+    """Shorten long strings at any depth; returns (value, whether anything was cut)."""
+    if isinstance(value, str):
+        if len(value) > LOG_STRING_MAX_CHARS:
+            return value[:LOG_STRING_MAX_CHARS] + "…", True
+        return value, False
+    if isinstance(value, dict):
+        items = [(key, shorten_strings(item)) for key, item in value.items()]
+        return {key: item for key, (item, _) in items}, any(cut for _, (_, cut) in items)
+    if isinstance(value, list):
+        items = [shorten_strings(item) for item in value]
+        return [item for item, _ in items], any(cut for _, cut in items)
+    return value, False
+
+
+def compact_log_data(data: Dict) -> Dict:
+    """Keep log payloads under LOG_DATA_MAX_BYTES: shorten long strings, else keep a truncated preview."""
+    # msgspec, like the request decoder, also handles integers beyond 64 bits
+    if len(msgspec.json.encode(data)) <= LOG_DATA_MAX_BYTES:
+        return data
+    compacted, cut = shorten_strings(data)
+    encoded = msgspec.json.encode(compacted)
+    if len(encoded) > LOG_DATA_MAX_BYTES:
+        # Still too big (many values or deep nesting): store the start of the JSON instead
+        return {"_truncated": True, "_preview": encoded[:LOG_DATA_MAX_BYTES].decode("utf-8", "ignore")}
+    if cut:
+        compacted["_truncated"] = True
+    return compacted
+
+
+dropped_log_events = 0  # /log events discarded because the write queue was full
+
+
 @app.post("/log")
-async def log_activity(request: LogRequest):
+async def log_activity(http_request: Request, background_tasks: BackgroundTasks):
     """Log frontend activity."""
     try:
-        supabase.table("activity_logs").insert({
-            "session_id": request.session_id,
-            "event_type": request.event_type,
-            "event_category": request.event_category,
-            "data": request.data
-        }).execute()
-    except Exception as e:
-        print(f"Log error: {e}")
+        request = LOG_REQUEST_DECODER.decode(await http_request.body())
+    except msgspec.DecodeError as e:
+        return ORJSONResponse({"status": "error", "message": str(e)}, status_code=422)
+    row = {
+        "session_id": request.session_id,
+        "event_type": request.event_type,
+        "event_category": request.event_category,
+        "data": compact_log_data(request.data)
+    }
+    global dropped_log_events
+    if write_queue is None:
+        # Writer not running: insert after the response instead of waiting on it
+        background_tasks.add_task(run_blocking, insert_rows, "activity_logs", [row])
+    elif write_queue.full():
+        # Supabase is already behind; extra inserts would only tie up the thread pool, so drop the event
+        dropped_log_events += 1
+        logger.warning("Write queue full, dropped activity log event (%s dropped so far)", dropped_log_events)
+    else:
+        write_queue.put_nowait(("activity_logs", row))
     return {"status": "ok"}
 
 
 # ============== Reprocess Endpoint ==============
 
+@functools.lru_cache(maxsize=64)
+def build_audit_prompt(column_name: Optional[str], organization_type: Optional[str]) -> str:
+    """Audit prompt with the user's column and organization hints appended."""
+    prompt = SWISS_TAX_AUDIT_PROMPT
+    if column_name:
+        prompt += f"\n\nWICHTIG: Verwende die Spalte '{column_name}' für die Datenextraktion!"
+    if organization_type:
+        prompt += f"\n\nOrganisation: {organization_type}"
+    return prompt
+
+
 @app.post("/reprocess")
 async def reprocess_files(request: ReprocessRequest):
     """Reprocess files with new context."""
     session_id = request.session_id
     
     # Re-run LLM analysis with context
-    enhanced_prompt = SWISS_TAX_AUDIT_PROMPT
-    if request.column_name:
-        enhanced_prompt += f"\n\nWICHTIG: Verwende die Spalte '{request.column_name}' für die Datenextraktion!"
-    if request.organization_type:
-        enhanced_prompt += f"\n\nOrganisation: {request.organization_type}"
-    
-    llm_result = await analyze_pdfs_with_llm(session_id, "sonnet")
+    enhanced_prompt = build_audit_prompt(request.column_name, request.organization_type)
+    # Reprocess means "run it again": bypass the analysis cache
+    llm_result = await analyze_pdfs_with_llm(session_id, "sonnet", enhanced_prompt, use_cache=False)
     audit_results = build_audit_results(llm_result)
     
     # Update session
-    if session_id in chat_sessions:
-        chat_sessions[session_id]["llm_result"] = llm_result
+    session = await load_chat_session(session_id)
+    if session is not None:
+        session["llm_result"] = llm_result
+        await save_chat_session(session_id, session)
     
-    return {
+    # Returning the response directly skips FastAPI's jsonable_encoder pass over the dumped dicts
+    return ORJSONResponse({
         "results": [r.model_dump() for r in audit_results],
         "session_id": session_id
-    }
+    })